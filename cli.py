@@ -1,174 +1,226 @@
 import argparse
 import sys
 import os
-import data
 
 
-parser = argparse.ArgumentParser()
-commands = parser.add_subparsers(dest="command", required=True)
+def main(argv=sys.argv[1:]):
+    command = argv[0] if argv else None
+    if command in COMMANDS:
+        # Parse only the command's own arguments with its subparser, so the main
+        # parser is neither filled with every subparser nor run over argv
+        build, handler = COMMANDS[command]
+        commands = argparse.ArgumentParser().add_subparsers(dest="command")
+        args = build(commands).parse_args(argv[1:])
+        args.command = command
+    else:
+        # Help, a missing or an unknown command, which the full parser reports
+        args = build_parser().parse_args(argv)
+        _, handler = COMMANDS[args.command]
+    handler(args)
 
 
-def main(argv=sys.argv[1:]):
-    args = parser.parse_args(argv)
-    match args.command:
-        case "init":
-            cmd_init(args)
-        case "hash-object":
-            cmd_hash_object(args)
-        case "cat-file":
-            cmd_cat_file(args)
-        case "write-tree":
-            cmd_write_tree(args)
-        case "read-tree":
-            cmd_read_tree(args)
-        case "commit":
-            cmd_commit(args)
-        case "log":
-            cmd_log(args)
-        case "checkout":
-            cmd_checkout(args)
-        case "tag":
-            cmd_tag(args)
-        case "k":
-            cmd_k(args)
-        case _:
-            parser.print_help()
-            sys.exit(1)
+def build_parser() -> argparse.ArgumentParser:
+    """Builds the argument parser with the subparsers of all commands."""
+
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    for build, _ in COMMANDS.values():
+        build(commands)
+
+    return parser
 
 
 # ------------------------------- INIT -------------------------------
 
-init_parser = commands.add_parser("init", help="Initialize a new repository.")
-init_parser.add_argument(
-    "path", nargs="?", default=".", help="Where to create the repository."
-)
+def build_init_parser(commands: argparse._SubParsersAction):
+    init_parser = commands.add_parser("init", help="Initialize a new repository.")
+    init_parser.add_argument(
+        "path", nargs="?", default=".", help="Where to create the repository."
+    )
+    return init_parser
 
 
 def cmd_init(args: argparse.Namespace):
+    import data
+
     data.init(args)
     print(f"Initialized empty repository in {os.path.abspath(args.path)}/{data.GITDIR}")
 
 
 # ------------------------------- HASH-OBJECT -------------------------------
 
-hash_object_parser = commands.add_parser(
-    "hash-object",
-    help="Hashes the data and stores it in the objects directory in the git directory.",
-)
-hash_object_parser.add_argument("file", help="File to hash.")
-hash_object_parser.add_argument(
-    "-t",
-    metavar="type",
-    dest="type",
-    choices=["blob", "commit", "tag", "tree"],
-    default="blob",
-    help="Specify the type of the object",
-)
-hash_object_parser.add_argument(
-    "-w",
-    dest="write",
-    action="store_true",
-    help="Actually write the object into the database",
-)
+def build_hash_object_parser(commands: argparse._SubParsersAction):
+    hash_object_parser = commands.add_parser(
+        "hash-object",
+        help="Hashes the data and stores it in the objects directory in the git directory.",
+    )
+    hash_object_parser.add_argument("file", help="File to hash.")
+    hash_object_parser.add_argument(
+        "-t",
+        metavar="type",
+        dest="type",
+        choices=["blob", "commit", "tag", "tree"],
+        default="blob",
+        help="Specify the type of the object",
+    )
+    hash_object_parser.add_argument(
+        "-w",
+        dest="write",
+        action="store_true",
+        help="Actually write the object into the database",
+    )
+    return hash_object_parser
 
 
 def cmd_hash_object(args: argparse.Namespace):
+    import data
+
+    # hash_file streams blobs from regular files, other types are parsed so must be
+    # read whole
+    if args.type == "blob":
+        print(data.hash_file(args.file, args.write))
+        return
+
     with open(args.file, "rb") as f:
         print(data.hash_object(f.read(), args.type.encode("ascii"), args.write))
 
 
 # ------------------------------- CAT-FILE -----------------------------------
 
-cat_file_parser = commands.add_parser(
-    "cat-file",
-    help="Provide content of repository objects.",
-)
-cat_file_parser.add_argument(
-    "type",
-    choices=["blob", "commit", "tag", "tree"],
-    help="Specify the type of the object",
-)
-cat_file_parser.add_argument("object", type=data.get_oid, help="Object to display.")
+def build_cat_file_parser(commands: argparse._SubParsersAction):
+    cat_file_parser = commands.add_parser(
+        "cat-file",
+        help="Provide content of repository objects.",
+    )
+    cat_file_parser.add_argument(
+        "type",
+        choices=["blob", "commit", "tag", "tree"],
+        help="Specify the type of the object",
+    )
+    cat_file_parser.add_argument("object", help="Object to display.")
+    return cat_file_parser
 
 
 def cmd_cat_file(args: argparse.Namespace):
-    data.cat_file(args.object, args.type)
+    import data
+
+    data.cat_file(data.get_oid(args.object), args.type)
 
 
 # ------------------------------- WRITE-TREE -----------------------------------
 
-write_tree_parser = commands.add_parser(
-    "write-tree", help="Store a directory in the object database."
-)
+def build_write_tree_parser(commands: argparse._SubParsersAction):
+    return commands.add_parser(
+        "write-tree", help="Store a directory in the object database."
+    )
 
 
 def cmd_write_tree(_: argparse.Namespace):
+    import data
+
     print(data.write_tree())
 
 
 # ------------------------------- READ-TREE -------------------------------------
 
-read_tree_parser = commands.add_parser(
-    "read-tree", help="Read a tree into the current index."
-)
-read_tree_parser.add_argument("tree", type=data.get_oid, help="Tree to read.")
+def build_read_tree_parser(commands: argparse._SubParsersAction):
+    read_tree_parser = commands.add_parser(
+        "read-tree", help="Read a tree into the current index."
+    )
+    read_tree_parser.add_argument("tree", help="Tree to read.")
+    return read_tree_parser
 
 
 def cmd_read_tree(args: argparse.Namespace):
-    data.read_tree(args.tree)
+    import data
+
+    data.read_tree(data.get_oid(args.tree))
 
 
 # ------------------------------- COMMIT ---------------------------------------
 
-commit_parser = commands.add_parser("commit", help="Record changes to the repository.")
-commit_parser.add_argument(
-    "-m", "--message", required=True, dest="message", help="Commit message."
-)
+def build_commit_parser(commands: argparse._SubParsersAction):
+    commit_parser = commands.add_parser(
+        "commit", help="Record changes to the repository."
+    )
+    commit_parser.add_argument(
+        "-m", "--message", required=True, dest="message", help="Commit message."
+    )
+    return commit_parser
 
 
 def cmd_commit(args: argparse.Namespace):
+    import data
+
     print(data.commit(args.message))
 
 
 # ------------------------------- LOG ---------------------------------------
 
-log_parser = commands.add_parser("log", help="Show commit logs.")
-log_parser.add_argument(
-    "oid", nargs="?", default="@", type=data.get_oid, help="Commit to start at."
-)
+def build_log_parser(commands: argparse._SubParsersAction):
+    log_parser = commands.add_parser("log", help="Show commit logs.")
+    log_parser.add_argument("oid", nargs="?", default="@", help="Commit to start at.")
+    return log_parser
 
 
 def cmd_log(args: argparse.Namespace):
-    data.log(args.oid)
+    import data
+
+    data.log(data.get_oid(args.oid))
 
 
 # ------------------------------- CHECKOUT ---------------------------------------
 
-checkout_parser = commands.add_parser("checkout", help="Checkout a commit.")
-checkout_parser.add_argument("oid", type=data.get_oid, help="Commit to checkout.")
+def build_checkout_parser(commands: argparse._SubParsersAction):
+    checkout_parser = commands.add_parser("checkout", help="Checkout a commit.")
+    checkout_parser.add_argument("oid", help="Commit to checkout.")
+    return checkout_parser
 
 
 def cmd_checkout(args: argparse.Namespace):
-    data.checkout(args.oid)
+    import data
+
+    data.checkout(data.get_oid(args.oid))
 
 
 # ------------------------------- TAG ---------------------------------------
 
-tag_parser = commands.add_parser("tag", help="Create a tag.")
-tag_parser.add_argument("name", help="Name of the tag.")
-tag_parser.add_argument(
-    "oid", nargs="?", default="@", type=data.get_oid, help="The commit to tag."
-)
+def build_tag_parser(commands: argparse._SubParsersAction):
+    tag_parser = commands.add_parser("tag", help="Create a tag.")
+    tag_parser.add_argument("name", help="Name of the tag.")
+    tag_parser.add_argument("oid", nargs="?", default="@", help="The commit to tag.")
+    return tag_parser
 
 
 def cmd_tag(args: argparse.Namespace):
-    data.create_tag(args.name, args.oid)
+    import data
+
+    data.create_tag(args.name, data.get_oid(args.oid))
 
 
 # ------------------------------- K (VISUALIZE) ---------------------------------
 
-k_parser = commands.add_parser("k", help="Visualize all refs.")
+def build_k_parser(commands: argparse._SubParsersAction):
+    return commands.add_parser("k", help="Visualize all refs.")
 
 
 def cmd_k(_: argparse.Namespace):
+    import data
+
     data.show_refs_and_commits()
+
+
+# (parser builder, handler) for each command. Only the builder for the requested
+# command is invoked, so unused subparsers are never constructed.
+COMMANDS = {
+    "init": (build_init_parser, cmd_init),
+    "hash-object": (build_hash_object_parser, cmd_hash_object),
+    "cat-file": (build_cat_file_parser, cmd_cat_file),
+    "write-tree": (build_write_tree_parser, cmd_write_tree),
+    "read-tree": (build_read_tree_parser, cmd_read_tree),
+    "commit": (build_commit_parser, cmd_commit),
+    "log": (build_log_parser, cmd_log),
+    "checkout": (build_checkout_parser, cmd_checkout),
+    "tag": (build_tag_parser, cmd_tag),
+    "k": (build_k_parser, cmd_k),
+}
@@ -1,18 +1,34 @@
 import collections
+import concurrent.futures
+import functools
 import hashlib
 import os
-import configparser
 import argparse
 from abc import ABC, abstractmethod
 import zlib
 import sys
 import textwrap
-from colors import *
+import stat
 import string
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import configparser
 
 
 GITDIR = ".pygit"
 
+# Files and directories that are never tracked
+IGNORED_NAMES = frozenset((GITDIR, ".git", "__pycache__"))
+
+# Size of the chunks files are read in when hashing and storing them
+CHUNK_SIZE = 1 << 16
+
+# zlib level for stored objects. 1 is several times faster than the default of 6
+# at the cost of slightly larger objects, and any level reads back the same
+COMPRESSION_LEVEL = 1
+
 
 # ------------------------------- INIT AND REPO -------------------------------
 
@@ -36,17 +52,17 @@ class GitRepository(object):
             raise Exception(f"Not a Git repository: {path}")
 
         # Read config file in .git/config
-        self.config = configparser.ConfigParser()
+        self.config = {}
         config_file = repo_file(self, "config")
 
         if config_file and os.path.exists(config_file):
-            self.config.read([config_file])
+            self.config = repo_read_config(config_file)
         elif not force:
             raise Exception("Error creating repository: configuration file missing")
 
         # Make sure repositoryformatversion is 0
         if not force:
-            version = int(self.config.get("core", "repositoryformatversion"))
+            version = int(self.config["core"]["repositoryformatversion"])
             if version != 0:
                 raise Exception(
                     f"Error creating repository: unsupported repositoryformatversion {version}"
@@ -86,13 +102,16 @@ def repo_create(path: str):
 
     # Create .git/config
     with open(repo_file(repo, "config"), "w") as f:
-        config: configparser.ConfigParser = repo_default_config()
+        config = repo_default_config()
         config.write(f)
 
     return repo
 
 
-def repo_default_config() -> configparser.ConfigParser:
+def repo_default_config() -> "configparser.ConfigParser":
+    # Imported here as only init writes a config, reading one doesn't need configparser
+    import configparser
+
     config_parser = configparser.ConfigParser()
     config_parser.add_section("core")
 
@@ -109,6 +128,37 @@ def repo_default_config() -> configparser.ConfigParser:
     return config_parser
 
 
+def repo_read_config(path: str) -> dict[str, dict[str, str]]:
+    """Reads the config file at path into a dict of sections, each a dict of keys to
+    values. Handles the plain 'key = value' files pygit writes by hand, and falls
+    back to configparser for any other syntax."""
+
+    config = {}
+    section = None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(("#", ";")):
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                section = config.setdefault(line[1:-1].strip(), {})
+                continue
+
+            key, sep, value = line.partition("=")
+            if section is None or not sep:
+                break
+            # configparser lowercases keys, do the same
+            section[key.strip().lower()] = value.strip()
+        else:
+            return config
+
+    import configparser
+
+    config_parser = configparser.ConfigParser()
+    config_parser.read([path])
+    return {name: dict(config_parser[name]) for name in config_parser.sections()}
+
+
 def repo_path(repo, *path: str) -> str:
     """Compute path under repo's gitdir."""
     return os.path.join(repo.gitdir, *path)
@@ -140,24 +190,36 @@ def repo_dir(repo, *path: str, mkdir=False) -> str | None:
         return None
 
 
+# Repositories already found in this process, keyed by the resolved start path
+_repo_cache: dict[str, GitRepository] = {}
+
+
 def repo_find(path: str = ".", required: bool = True) -> GitRepository | None:
     """Find the git repository the current directory is in."""
 
-    path = os.path.realpath(path)
-    if os.path.isdir(os.path.join(path, GITDIR)):
-        return GitRepository(path)
+    start = os.path.realpath(path)
+    if start in _repo_cache:
+        return _repo_cache[start]
 
-    # If we haven't found a git repo in the current directory, check parent
-    parent = os.path.realpath(os.path.join(path, ".."))
+    path = start
+    while True:
+        if os.path.isdir(os.path.join(path, GITDIR)):
+            repo = GitRepository(path)
+            _repo_cache[start] = repo
+            return repo
 
-    # If we're at the root, return None, or raise an exception if required
-    if parent == path:
-        if required:
-            raise Exception("No repository found.")
-        else:
-            return None
+        # If we haven't found a git repo in the current directory, check parent.
+        # path is already resolved, so dirname is enough to walk up
+        parent = os.path.dirname(path)
 
-    return repo_find(parent, required)
+        # If we're at the root, return None, or raise an exception if required
+        if parent == path:
+            if required:
+                raise Exception("No repository found.")
+            else:
+                return None
+
+        path = parent
 
 
 # ------------------------------- OBJECTS -------------------------------
@@ -194,15 +256,25 @@ class GitBlob(GitObject):
         self.blob_data = data
         
 
-def read_object(repo: GitRepository, hash: str) -> GitObject | None:
+def read_object(repo: GitRepository, hash: str, cache: bool = True) -> GitObject | None:
     """Reads object with sha-1 hash from git repository repo.
-    Returns a GitObject constructed from the object data."""
+    Returns a GitObject constructed from the object data. The object is kept in a
+    cache unless cache is False, which callers reading blobs once should pass so that
+    file contents aren't held in memory."""
 
     path = repo_file(repo, "objects", hash[:2], hash[2:])
 
     if not os.path.isfile(path):
         return None
 
+    if cache:
+        return _read_object_cached(path, hash)
+    return _read_object_file(path, hash)
+
+
+def _read_object_file(path: str, hash: str) -> GitObject:
+    """Decompresses and parses the object with sha-1 hash stored at path."""
+
     with open(path, "rb") as f:
         raw = zlib.decompress(f.read())
 
@@ -233,6 +305,10 @@ def read_object(repo: GitRepository, hash: str) -> GitObject | None:
         return c(data=raw[y+1:])
 
 
+# Objects never change once written, so parsed objects are shared between reads
+_read_object_cached = functools.lru_cache(maxsize=4096)(_read_object_file)
+
+
 def write_object(obj: GitObject, repo: GitRepository = None) -> str:
     """Writes the data to the repository repo. Returns the hash of the object."""
 
@@ -245,14 +321,60 @@ def write_object(obj: GitObject, repo: GitRepository = None) -> str:
     sha1 = hashlib.sha1(data_with_header).hexdigest()
 
     if repo:
-        path = repo_file(repo, "objects", sha1[:2], sha1[2:], mkdir=True)
-        if not os.path.exists(path):
-            with open(path, "wb") as f:
-                f.write(zlib.compress(data_with_header))
+        store_object(repo, sha1, data_with_header)
 
     return sha1
 
 
+# Object directories (objects/xx) known to exist, so each is only created once
+_object_dirs: set[str] = set()
+
+
+def object_path(repo: GitRepository, sha1: str) -> str:
+    """Returns the path of the object with hash sha1 in the repository repo,
+    creating its directory if absent."""
+
+    directory = repo_path(repo, "objects", sha1[:2])
+    if directory not in _object_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _object_dirs.add(directory)
+
+    return os.path.join(directory, sha1[2:])
+
+
+def object_tmp_path(repo: GitRepository) -> str:
+    """Returns a path in the object store to write an object to before moving it into
+    place, so that objects stored concurrently with the same hash never interleave
+    and a partial object is never left at its final path. Failed writes remove their
+    file, but one left by a killed process stays until deleted by hand. Nothing reads
+    these files, so a leftover only takes up space."""
+
+    return repo_path(repo, "objects", f"tmp_{os.getpid()}_{threading.get_ident()}")
+
+
+def remove_object_tmp(tmp_path: str) -> None:
+    """Removes a temporary object file left by a failed write, if it was created."""
+
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+
+def store_object(repo: GitRepository, sha1: str, data: bytes) -> None:
+    """Compresses the already hashed object data and stores it under sha1 in the
+    repository repo, unless an object with that hash is already stored."""
+
+    path = object_path(repo, sha1)
+    if not os.path.exists(path):
+        tmp_path = object_tmp_path(repo)
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(zlib.compress(data, COMPRESSION_LEVEL))
+            os.replace(tmp_path, path)
+        except BaseException:
+            remove_object_tmp(tmp_path)
+            raise
+
+
 def find_object(repo: GitRepository, name: str, fmt=None, follow=True) -> str:
     """Finds an object specified by name, which can be the full hash, short hash, tags, etc."""
 
@@ -283,6 +405,67 @@ def hash_object(data: bytes, fmt: bytes, write: bool) -> str:
     return write_object(obj, repo)
 
 
+def hash_file(path: str, write: bool) -> str:
+    """Hashes the file at path as a blob, reading it in chunks instead of into memory.
+    If write is True and the blob isn't stored yet, it is compressed and stored in
+    the objects directory. Returns the object id (SHA-1 hash)."""
+
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+
+        # Only a regular file's size is known up front, read anything else (e.g. a
+        # pipe) whole
+        if not stat.S_ISREG(st.st_mode):
+            return hash_object(f.read(), b"blob", write)
+
+        size = st.st_size
+        header = b"blob " + str(size).encode("ascii") + b"\x00"
+
+        # file_digest runs the read and update loop in C
+        sha1 = hashlib.file_digest(f, lambda: hashlib.sha1(header)).hexdigest()
+        check_file_size(path, f, size)
+        if not write:
+            return sha1
+
+        # Objects are content-addressed, so one already stored needs no compressing
+        repo = repo_find()
+        object_file = object_path(repo, sha1)
+        if os.path.exists(object_file):
+            return sha1
+
+        # Compress from a second read, hashing it again so that the stored object is
+        # known to match sha1 even if the file changed in between
+        f.seek(0)
+        sha = hashlib.sha1(header)
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        tmp_path = object_tmp_path(repo)
+        try:
+            with open(tmp_path, "wb") as out:
+                out.write(compressor.compress(header))
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    sha.update(chunk)
+                    out.write(compressor.compress(chunk))
+                out.write(compressor.flush())
+            check_file_size(path, f, size)
+            if sha.hexdigest() != sha1:
+                raise Exception(f"File changed while being hashed: {path}")
+
+            os.replace(tmp_path, object_file)
+        except BaseException:
+            remove_object_tmp(tmp_path)
+            raise
+
+    return sha1
+
+
+def check_file_size(path: str, f, size: int) -> None:
+    """Raises if the number of bytes read from f differs from size. The blob header
+    is built from the size before reading, so the file must not have changed since."""
+
+    if f.tell() != size:
+        raise Exception(f"File changed while being hashed: {path}")
+
+
 def cat_file(obj: str, fmt: str) -> bytes:
     repo = repo_find()
     object = read_object(repo, find_object(repo, obj, fmt=fmt))
@@ -293,9 +476,13 @@ def cat_file(obj: str, fmt: str) -> bytes:
 
 class GitTreeRecord(object):
     """Represents a single record in a GitTree.
-    Format of tree record: <filemode> space <path> space <sha-1>"""
+    Format of tree record: <filemode> space <path> space <sha-1>
+    The sha-1 is kept as the raw 20 bytes stored in the tree, not as a hex string."""
+
+    # Trees can hold many records, so store attributes in slots instead of a __dict__
+    __slots__ = ("fmt", "path", "sha")
 
-    def __init__(self, fmt: str, path: str, sha: str) -> None:
+    def __init__(self, fmt: str, path: str, sha: bytes) -> None:
         self.fmt = fmt
         self.path = path
         self.sha = sha
@@ -327,8 +514,8 @@ def parse_record(raw: bytes, start: int = 0) -> tuple[int, GitTreeRecord]:
     y = raw.find(b" ", x + 1)
     path = raw[x + 1 : y].decode("utf-8")
 
-    # Read sha and convert to hex string
-    sha = format(int.from_bytes(raw[y + 1 : y + 21], "big"), "040x")
+    # Read raw sha
+    sha = raw[y + 1 : y + 21]
 
     # Return end index of record + 1 (y+21) for next iteration when parsing a tree
     return y + 21, GitTreeRecord(fmt, path, sha)
@@ -360,48 +547,65 @@ def tree_record_sort_key(record: GitTreeRecord) -> str:
 def tree_serialize(tree: GitTree) -> bytes:
     """Serializes a Git tree."""
 
-    res = b""
+    # Build into a bytearray, which grows in place instead of copying on each record
+    res = bytearray()
     tree.records.sort(key=tree_record_sort_key)
     for record in tree.records:
-        res += (
-            record.fmt.encode("utf-8")
-            + b" "
-            + record.path.encode("utf-8")
-            + b" "
-            + bytes.fromhex(record.sha)
-        )
+        res += record.fmt.encode("utf-8")
+        res += b" "
+        res += record.path.encode("utf-8")
+        res += b" "
+        res += record.sha
 
-    return res
+    return bytes(res)
 
 
 def write_tree(directory: str = ".") -> str:
     """Writes a tree object from the given directory and returns the hash of the tree object."""
 
-    with os.scandir(directory) as it:
-        tree = GitTree()
-        for entry in it:
-            full = os.path.join(directory, entry.name)
-            if full == None or is_ignored(full):
-                continue
-
-            if entry.is_file(follow_symlinks=False):
-                with open(full, "rb") as f:
-                    raw = f.read()
-                    fmt = "blob"
-                    oid = hash_object(raw, b"blob", True)
-            elif entry.is_dir(follow_symlinks=False):
-                fmt = "tree"
-                oid = write_tree(full)
-            tree.records.append(GitTreeRecord(fmt, entry.name, oid))
-        
-    return hash_object(tree.serialize(), b"tree", True)
-
-
-def is_ignored(path: str) -> bool:
-    """Returns True if the path is ignored, False otherwise."""
+    repo = repo_find()
 
-    dirs = path.split("/")
-    return ".pygit" in dirs or ".git" in dirs or "__pycache__" in dirs
+    # Scan directories parents first, so that reversing the list gives an order
+    # in which every subdirectory is written before the directory containing it
+    scanned = []
+    stack = [directory]
+    while stack:
+        path = stack.pop()
+        with os.scandir(path) as it:
+            # Parents of ignored names are never descended into, so the name suffices
+            entries = [entry for entry in it if entry.name not in IGNORED_NAMES]
+        stack.extend(e.path for e in entries if e.is_dir(follow_symlinks=False))
+        scanned.append((path, entries))
+
+    # Hash and store blobs concurrently, hashlib, zlib and file I/O release the GIL
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        try:
+            blobs = {}
+            for _, entries in scanned:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        blobs[entry.path] = executor.submit(hash_file, entry.path, True)
+
+            oids = {}
+            for path, entries in reversed(scanned):
+                tree = GitTree()
+                for entry in entries:
+                    if entry.path in blobs:
+                        oid = blobs[entry.path].result()
+                        record = GitTreeRecord("blob", entry.name, bytes.fromhex(oid))
+                    elif entry.is_dir(follow_symlinks=False):
+                        oid = oids.pop(entry.path)
+                        record = GitTreeRecord("tree", entry.name, bytes.fromhex(oid))
+                    else:
+                        continue
+                    tree.records.append(record)
+                oids[path] = write_object(tree, repo)
+        except BaseException:
+            # Cancel the blobs not started yet instead of hashing them all first
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    return oids[directory]
 
 
 def read_tree(oid: str):
@@ -413,38 +617,43 @@ def read_tree(oid: str):
     for path, oid in get_tree_paths(repo, oid).items():
         os.makedirs(os.path.dirname(path), exist_ok=True)
         with open(path, "wb") as f:
-            f.write(read_object(repo, oid).serialize())
+            f.write(read_object(repo, oid, cache=False).serialize())
         
         
 def get_tree_paths(repo: GitRepository, oid: str, base_path = "./") -> dict[str, str]:
     res = {}
-    tree: GitTree = read_object(repo, find_object(repo, oid))
-    for record in tree.records:
-        path = base_path + record.path
-        if record.fmt == "blob":
-            res[path] = record.sha
-        elif record.fmt == "tree":
-            res.update(get_tree_paths(repo, record.sha, f"{path}/"))
-        else:
-            raise Exception(f"Unknown tree entry {record.fmt}")
+    stack = [(oid, base_path)]
+    while stack:
+        oid, base_path = stack.pop()
+        tree: GitTree = read_object(repo, find_object(repo, oid))
+        for record in tree.records:
+            path = base_path + record.path
+            if record.fmt == "blob":
+                res[path] = record.sha.hex()
+            elif record.fmt == "tree":
+                stack.append((record.sha.hex(), path + "/"))
+            else:
+                raise Exception(f"Unknown tree entry {record.fmt}")
     return res
 
 
 def _empty_cur_dir():
-    for root, dirs, files in os.walk(".", topdown=False):
+    walked = []
+    for root, dirs, files in os.walk(".", topdown=True):
+        # Prune ignored directories in place so os.walk never descends into them
+        dirs[:] = [dirname for dirname in dirs if dirname not in IGNORED_NAMES]
         for filename in files:
-            path = os.path.relpath(os.path.join(root, filename))
-            if is_ignored(path):
+            if filename in IGNORED_NAMES:
                 continue
-            os.remove(path)
-        for dirname in dirs:
-            path = os.path.relpath(os.path.join(root, dirname))
-            if is_ignored(path):
-                continue
-            try:
-                os.rmdir(path)
-            except (FileNotFoundError, OSError):
-                pass    # Directory might not be empty if it contains ignored files
+            os.remove(os.path.join(root, filename))
+        walked.append(root)
+
+    # Remove emptied directories deepest first, leaving the current directory itself
+    for path in reversed(walked[1:]):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass    # Directory might not be empty if it contains ignored files
 
 
 # ---------------------------------- COMMITS -----------------------------------
@@ -484,44 +693,49 @@ def commit(message: str) -> str:
     return oid
         
 
-def kvlm_parse(raw: bytes, start: int=0, dct: dict=None) -> dict[str, str]:
+def kvlm_parse(raw: bytes, start: int=0) -> dict[str, str]:
     """Parses a key-value list with message, which can be a commit or a tag."""
     
-    if not dct:
-        dct = collections.OrderedDict()
+    dct = collections.OrderedDict()
 
-    space_index = raw.find(b" ", start)
-    newline_index = raw.find(b"\n", start)
-    
-    # If no space is found or newline is found before space, the remaining data is the message
-    if space_index < 0 or newline_index < space_index:
-        assert newline_index == start
-        dct[None] = raw[start+1:].decode()
-        return dct
-    
-    key = raw[start:space_index].decode()
-    
-    # Find the end of the value. Each continuation line starts with a space so we need to find
-    # the first newline that is not followed by a space
-    end = start
     while True:
-        end = raw.find(b"\n", end + 1)
-        if raw[end + 1] != ord(" "):
-            break
+        space_index = raw.find(b" ", start)
+        newline_index = raw.find(b"\n", start)
+        if newline_index < 0:
+            raise Exception("Malformed key-value list: missing message")
         
-    # Drop the leading spaces from the value
-    value = raw[space_index+1:end].replace(b"\n ", b"\n").decode()
-    
-    # If the key already exists, append the value to form a list
-    if key in dct:
-        if type(dct[key]) == list:
-            dct[key].append(value)
+        # If no space is found or newline is found before space, the remaining data is the message
+        if space_index < 0 or newline_index < space_index:
+            assert newline_index == start
+            dct[None] = raw[start+1:].decode()
+            return dct
+        
+        key = raw[start:space_index].decode()
+        
+        # Find the end of the value. Each continuation line starts with a space so we need to find
+        # the first newline that is not followed by a space
+        end = start
+        while True:
+            end = raw.find(b"\n", end + 1)
+            # A value must end with a newline before the message
+            if end < 0:
+                raise Exception("Malformed key-value list: missing message")
+            if raw[end + 1:end + 2] != b" ":
+                break
+            
+        # Drop the leading spaces from the value
+        value = raw[space_index+1:end].replace(b"\n ", b"\n").decode()
+        
+        # If the key already exists, append the value to form a list
+        if key in dct:
+            if type(dct[key]) == list:
+                dct[key].append(value)
+            else:
+                dct[key] = [dct[key], value]
         else:
-            dct[key] = [dct[key], value]
-    else:
-        dct[key] = value
-    
-    return kvlm_parse(raw, start=end+1, dct=dct)
+            dct[key] = value
+        
+        start = end + 1
 
 
 def kvlm_serialize(kvlm: dict[str, str]) -> bytes:
@@ -649,26 +863,32 @@ def iter_refs():
 def log(oid: str) -> None:
     """Prints the commit log starting from commit with given oid."""
     
+    # Only log prints colors, so other commands never import colors
+    from colors import CYAN, RESET, YELLOW
+
     repo = repo_find()
     head = get_ref("HEAD")
     
+    # Collect the output and write it once, instead of several prints per commit
+    out = []
     while oid:
         commit: GitCommit = read_object(repo, oid)
-        print(f"{YELLOW}commit {oid}{RESET}", end="")
+        out.append(f"{YELLOW}commit {oid}{RESET}")
         
         # Mark HEAD
         if (oid == head):
-            print(f" {YELLOW}({RESET}{CYAN}HEAD{RESET}{YELLOW}){RESET}")
-        else:
-            print()
-        print()
+            out.append(f" {YELLOW}({RESET}{CYAN}HEAD{RESET}{YELLOW}){RESET}")
+        out.append("\n\n")
         
-        print(textwrap.indent(commit.kvlm[None], "    "))
+        out.append(textwrap.indent(commit.kvlm[None], "    "))
+        out.append("\n")
         
-        if "parent" in commit.kvlm:
-            oid = commit.kvlm["parent"]
-        else:
-            oid = None
+        # Follow the first parent of merge commits
+        oid = commit.kvlm.get("parent")
+        if type(oid) == list:
+            oid = oid[0]
+
+    sys.stdout.write("".join(out))
 
 
 # ------------------------------- CHECKOUT -----------------------------------